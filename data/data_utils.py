@@ -16,26 +16,40 @@ def save_dataset(questions, solutions, filename="synthetic_dataset.json"):
     
     return dataset
 
-def append_to_dataset(question, solution, filename):
+def write_dataset_atomic(dataset, filename):
+    """Write the dataset to a temp file and swap it in, so an interrupted write never corrupts it"""
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(dataset, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+def append_to_dataset(question, solution, filename, extra=None):
     # Check if file exists and load existing data
     if os.path.exists(filename):
         try:
             with open(filename, 'r') as f:
                 dataset = json.load(f)
         except json.JSONDecodeError:
+            # Keep the unreadable file for inspection instead of overwriting it
+            print(f"Warning: {filename} is not valid JSON; moved it to {filename}.corrupt")
+            os.replace(filename, filename + ".corrupt")
             dataset = []
     else:
         dataset = []
     
-    # Append new entry
-    dataset.append({
+    # Append new entry, with any extra fields (e.g. candidate solutions)
+    entry = {
         "user": question,
         "assistant": solution
-    })
+    }
+    if extra:
+        entry.update(extra)
+    dataset.append(entry)
     
     # Save updated dataset
-    with open(filename, 'w') as f:
-        json.dump(dataset, f, indent=2)
+    write_dataset_atomic(dataset, filename)
     
     return len(dataset)
 
@@ -61,6 +75,26 @@ def get_processed_questions(filename):
             return []
     return []
 
+def restore_row_order(filename, question_rows=None):
+    """
+    Sort saved entries back into source row order.
+    
+    Entries saved without a row (e.g. before length-aware scheduling was enabled)
+    get theirs from question_rows, a question -> row map of the loaded dataset.
+    If any entry's row is still unknown, the file is left as it is.
+    """
+    if not os.path.exists(filename):
+        return False
+    with open(filename, 'r') as f:
+        dataset = json.load(f)
+    question_rows = question_rows or {}
+    rows = [entry.get('row', question_rows.get(entry['user'])) for entry in dataset]
+    if any(row is None for row in rows):
+        return False
+    order = sorted(range(len(dataset)), key=lambda i: rows[i])
+    write_dataset_atomic([dataset[i] for i in order], filename)
+    return True
+
 def upload_to_huggingface(dataset_data, repo_name):
     dataset = Dataset.from_list(dataset_data)
     dataset.push_to_hub(repo_name, private=False)
\ No newline at end of file
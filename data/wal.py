@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import time
+
+DISPATCHED = "dispatched"
+COMPLETED = "completed"
+PERSISTED = "persisted"
+FAILED = "failed"
+
+
+class WriteAheadLog:
+    """
+    Append-only log of per-row generation state, stored as JSON lines next to the output file.
+
+    Each row moves through dispatched -> completed -> persisted, or ends up failed.
+    Completed records carry the response, so work that finished but never reached
+    the dataset file can be replayed after a crash instead of being paid for again.
+    Every record is flushed and fsynced before the call returns.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self._lock = threading.Lock()
+        self._load()
+        self._compact()
+        self._file = open(self.path, 'a')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from a crash mid-write; earlier records are intact
+                    continue
+                self.state[record["row"]] = record
+
+    def _compact(self):
+        """Rewrite the log keeping only the latest record of rows that are not yet persisted."""
+        self.state = {row: r for row, r in self.state.items() if r["status"] != PERSISTED}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            for record in self.state.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _write(self, row, status, **fields):
+        record = {"row": row, "status": status, "time": time.time(), **fields}
+        with self._lock:
+            self.state[row] = record
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def dispatched(self, row, question):
+        self._write(row, DISPATCHED, question=question)
+
+    def completed(self, row, question, solution):
+        self._write(row, COMPLETED, question=question, solution=solution)
+
+    def persisted(self, row):
+        self._write(row, PERSISTED)
+
+    def failed(self, row, question, error=None):
+        self._write(row, FAILED, question=question, error=error)
+
+    def pending_replay(self):
+        """Completed records whose responses never reached the dataset file, in row order."""
+        with self._lock:
+            return sorted((r for r in self.state.values() if r["status"] == COMPLETED),
+                          key=lambda r: r["row"])
+
+    def rows_with_status(self, status):
+        with self._lock:
+            return {row for row, r in self.state.items() if r["status"] == status}
+
+    def close(self):
+        self._file.close()
@@ -2,19 +2,182 @@ import sys
 import json
 import os
 import time
+import signal
+import threading
+from contextlib import contextmanager
 from utils.azure_ai import get_azure_response, get_azure_responses_batch, get_azure_responses_parallel
 from utils.rockbed import get_bedrock_response, get_bedrock_responses_parallel
 from utils.localgen import get_ollama_response, get_ollama_responses_parallel
 from data.data_loader import load_tinygsm_questions
-from data.data_utils import save_dataset, upload_to_huggingface, append_to_dataset, get_processed_count, get_processed_questions
+from data.wal import WriteAheadLog, FAILED
+from data.data_utils import save_dataset, upload_to_huggingface, append_to_dataset, get_processed_count, get_processed_questions, restore_row_order
+from utils.tracing import tracer, SamplingProfiler
+from utils.hedging import HedgePolicy
+from utils.execution import majority_answer
+from utils.scheduling import LengthEstimator, estimate_tokens
 
-def generate_solutions(questions, config, output_path, batch_size=10, use_batch=True, config_file=None):
+def build_entry(candidates, config):
+    """
+    Pick the stored solution from several candidates for one question.
+    
+    Returns the solution and the extra entry fields. With majority_vote enabled,
+    the candidates are executed and the first one giving the most common answer
+    is stored as the solution.
+    """
+    extra = {"candidates": candidates}
+    solution = candidates[0]
+    if config.get('majority_vote', False):
+        answer, index, votes, answers = majority_answer(candidates, config.get('execution_timeout', 5))
+        extra["answers"] = answers
+        extra["majority_answer"] = answer
+        extra["agreement"] = votes / len(candidates)
+        if answer is not None:
+            solution = candidates[index]
+    return solution, extra
+
+def prepare_entry(solution, config, row=None):
+    """Turn a response (or list of candidates) into the stored solution and extra entry fields."""
+    extra = None
+    if isinstance(solution, list):
+        solution, extra = build_entry(solution, config)
+    if row is not None and config.get('scheduling', {}).get('length_aware', False):
+        extra = dict(extra or {}, row=row)
+    return solution, extra
+
+def get_solution(prompt, config, config_file=None, samples=1, row=None):
+    """
+    Get the completion for one prompt, or with samples > 1 the list of candidates.
+    
+    Providers without an n parameter get one request per sample, sent concurrently
+    through the provider's parallel helper; samples that succeed are kept even if
+    others fail. Raises if the request, or every sample, fails.
+    """
+    if 'bedrock_models' in config:
+        if samples == 1:
+            return get_bedrock_response(prompt, config_file)
+        fan_out = lambda on_complete: get_bedrock_responses_parallel(
+            [prompt], config_file, samples, samples=samples, on_complete=on_complete, rows=[row])
+    elif 'ollama_models' in config:
+        if samples == 1:
+            return get_ollama_response(prompt, config_file)
+        fan_out = lambda on_complete: get_ollama_responses_parallel(
+            [prompt], config_file, samples, samples=samples, on_complete=on_complete, rows=[row])
+    else:
+        deployment = config.get('azure_deployments', {}).get(config['deployment'], {})
+        if samples == 1 or deployment.get('supports_n', True):
+            return get_azure_response(prompt, config['deployment'], config, n=samples)
+        fan_out = lambda on_complete: get_azure_responses_batch(
+            [prompt], config['deployment'], config, batch_size=1, max_workers=samples,
+            samples=samples, on_complete=on_complete, rows=[row])
+    errors = []
+    solution = fan_out(lambda index, response, error=None: errors.append(error))[0]
+    if solution is None:
+        raise Exception(errors[-1] or f"All {samples} samples failed")
+    if len(solution) < samples:
+        print(f"  {samples - len(solution)} of {samples} samples failed for row {row}; keeping {len(solution)}")
+        tracer.mark("samples_failed", row=row, failed=samples - len(solution))
+    return solution
+
+def open_wal(output_path, config):
+    """Open the write-ahead log next to the output file, or None if disabled."""
+    if not config.get('wal', {}).get('enabled', True):
+        return None
+    return WriteAheadLog(f"{output_path}.wal")
+
+def replay_wal(wal, output_path, config):
+    """Save responses that completed before a crash but never reached the dataset file."""
+    pending = wal.pending_replay()
+    if not pending:
+        return 0
+    already_processed = set(get_processed_questions(output_path))
+    replayed = 0
+    for record in pending:
+        # The crash may have come between saving the entry and logging it as persisted
+        if record["question"] not in already_processed:
+            solution, extra = prepare_entry(record["solution"], config, record["row"])
+            append_to_dataset(record["question"], solution, output_path, extra)
+            replayed += 1
+        wal.persisted(record["row"])
+    print(f"Replayed {replayed} completed responses from {wal.path}")
+    return replayed
+
+class StopRequest:
+    """
+    Stop state driven by SIGINT/SIGTERM.
+    
+    The first signal asks the run to stop once in-flight requests finish. A second
+    one raises KeyboardInterrupt: requests that have not started are cancelled,
+    those already running are still waited for and logged to the write-ahead log,
+    and the rest of the batch is left for the next run to replay instead of being
+    saved. If it arrives while an entry is being persisted, the interrupt waits
+    until the dataset file and the write-ahead log are both up to date.
+    """
+    
+    def __init__(self):
+        self.requested = threading.Event()
+        self.forced = False
+        self._persisting = False
+    
+    def is_set(self):
+        return self.requested.is_set()
+    
+    @contextmanager
+    def persisting(self):
+        self._persisting = True
+        try:
+            yield
+        finally:
+            self._persisting = False
+            if self.forced:
+                raise KeyboardInterrupt
+    
+    def handle(self, signum, frame):
+        if not self.requested.is_set():
+            self.requested.set()
+            print("\n🛑 Stopping after in-flight requests finish (send again to exit now)...")
+        elif self._persisting:
+            self.forced = True
+        else:
+            raise KeyboardInterrupt
+
+@contextmanager
+def graceful_shutdown():
+    """Install SIGINT/SIGTERM handlers for the duration of a run and yield its StopRequest."""
+    stop = StopRequest()
+    previous = {sig: signal.signal(sig, stop.handle) for sig in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        yield stop
+    finally:
+        for sig, old_handler in previous.items():
+            signal.signal(sig, old_handler)
+
+def generate_solutions(questions, config, output_path, batch_size=10, use_batch=True, config_file=None, samples=1, start_row=0):
+    wal = open_wal(output_path, config)
+    if wal is not None:
+        with tracer.span("wal_replay"):
+            replay_wal(wal, output_path, config)
+    
     # Check for existing progress
-    already_processed = get_processed_questions(output_path)
+    with tracer.span("resume_scan"):
+        already_processed = get_processed_questions(output_path)
     processed_count = len(already_processed)
+    already_processed = set(already_processed)
     
-    # Filter out already processed questions
-    remaining_questions = [q for q in questions if q not in already_processed]
+    # Filter out already processed questions, keeping their source row numbers
+    remaining = [(start_row + i, q) for i, q in enumerate(questions) if q not in already_processed]
+    
+    # Rows that failed in an earlier run are retried unless configured otherwise
+    if wal is not None:
+        failed_rows = wal.rows_with_status(FAILED)
+        failed_remaining = [row for row, _ in remaining if row in failed_rows]
+        if failed_remaining:
+            if config.get('wal', {}).get('retry_failed', True):
+                print(f"Retrying {len(failed_remaining)} questions that failed in a previous run")
+            else:
+                print(f"Skipping {len(failed_remaining)} questions that failed in a previous run")
+                remaining = [(row, q) for row, q in remaining if row not in failed_rows]
+    remaining_rows = [row for row, _ in remaining]
+    remaining_questions = [q for _, q in remaining]
     
     if processed_count > 0:
         print(f"Resuming from {processed_count} already processed questions")
@@ -22,19 +185,33 @@ def generate_solutions(questions, config, output_path, batch_size=10, use_batch=
     
     if not remaining_questions:
         print("All questions already processed!")
+        if wal is not None:
+            wal.close()
         return processed_count
     
     total_questions = len(remaining_questions)
     times = []
     
     try:
-        if use_batch and ('azure_deployments' in config or 'bedrock_models' in config or 'ollama_models' in config):
-            # Use batch processing for Azure, Bedrock, or Ollama
-            print(f"Using batch processing with batch size {batch_size}")
-            return generate_solutions_batch(remaining_questions, config, output_path, processed_count, batch_size, config_file)
-        else:
-            # Use sequential processing
-            return generate_solutions_sequential(remaining_questions, config, output_path, processed_count, config_file)
+        with graceful_shutdown() as stop:
+            if use_batch and ('azure_deployments' in config or 'bedrock_models' in config or 'ollama_models' in config):
+                # Use batch processing for Azure, Bedrock, or Ollama
+                print(f"Using batch processing with batch size {batch_size}")
+                count = generate_solutions_batch(remaining_questions, config, output_path, processed_count, batch_size, config_file, samples, remaining_rows, wal, stop)
+                
+                # Scheduling reorders the output; put it back into source row order
+                scheduling_config = config.get('scheduling', {})
+                if scheduling_config.get('length_aware', False) and scheduling_config.get('restore_order', True):
+                    question_rows = {q: start_row + i for i, q in enumerate(questions)}
+                    with tracer.span("restore_order"):
+                        if restore_row_order(output_path, question_rows):
+                            print("Restored saved entries to source row order")
+                        else:
+                            print("Could not restore source row order: some entries have no known row")
+                return count
+            else:
+                # Use sequential processing
+                return generate_solutions_sequential(remaining_questions, config, output_path, processed_count, config_file, samples, remaining_rows, wal, stop)
     
     except Exception as e:
         if "RATE_LIMIT_EXCEEDED" in str(e):
@@ -53,98 +230,177 @@ def generate_solutions(questions, config, output_path, batch_size=10, use_batch=
             raise e
         else:
             raise e
+    finally:
+        if wal is not None:
+            wal.close()
 
-def generate_solutions_batch(questions, config, output_path, processed_count, batch_size=10, config_file=None):
+def generate_solutions_batch(questions, config, output_path, processed_count, batch_size=10, config_file=None, samples=1, rows=None, wal=None, stop=None):
     """Generate solutions using batch processing for faster inference."""
     total_questions = len(questions)
     times = []
+    if stop is None:
+        stop = StopRequest()
     
-    # Process questions in batches
-    for i in range(0, total_questions, batch_size):
-        batch_start = time.time()
-        batch_questions = questions[i:i + batch_size]
-        batch_num = i // batch_size + 1
-        total_batches = (total_questions + batch_size - 1) // batch_size
-        
-        print(f"Processing batch {batch_num}/{total_batches} ({len(batch_questions)} questions)")
-        
-        # Prepare prompts for this batch
-        prompts = [f"{question}\n\n{config['prompt']}" for question in batch_questions]
-        
-        # Get batch responses
-        if 'azure_deployments' in config:
-            # Use Azure batch API
-            batch_config = config.get('batch_processing', {})
-            max_workers = batch_config.get('max_workers', 5)
-            responses = get_azure_responses_batch(prompts, config['deployment'], config, 
-                                               batch_size=len(batch_questions), 
-                                               max_workers=max_workers)
-        elif 'bedrock_models' in config:
-            # Use parallel processing for Bedrock
-            batch_config = config.get('batch_processing', {})
-            max_workers = batch_config.get('max_workers', 3)
-            responses = get_bedrock_responses_parallel(prompts, config_file, max_workers)
-        elif 'ollama_models' in config:
-            # Use parallel processing for Ollama
-            batch_config = config.get('batch_processing', {})
-            max_workers = batch_config.get('max_workers', 3)
-            responses = get_ollama_responses_parallel(prompts, config_file, max_workers)
-        else:
-            # Fallback to sequential for other APIs
-            responses = []
-            for prompt in prompts:
-                response = get_azure_response(prompt, config['deployment'], config)
-                responses.append(response)
-        
-        # Save each solution in the batch
-        for j, (question, solution) in enumerate(zip(batch_questions, responses)):
-            if solution is not None:
-                current_total = processed_count + i + j + 1
-                count = append_to_dataset(question, solution, output_path)
-                print(f"  Saved entry {count} ({j+1}/{len(batch_questions)} in batch)")
-            else:
-                print(f"  Failed to process question {i + j + 1}")
-        
-        batch_time = time.time() - batch_start
-        times.append(batch_time)
-        
-        # Calculate time estimates
-        avg_time = sum(times) / len(times)
-        remaining_batches = total_batches - batch_num
-        estimated_remaining = avg_time * remaining_batches
-        
-        # Format time display
-        def format_time(seconds):
-            if seconds < 60:
-                return f"{seconds:.1f}s"
-            elif seconds < 3600:
-                return f"{seconds/60:.1f}m"
+    # Length-aware scheduling: within a look-ahead window, dispatch the questions
+    # predicted to need the longest solutions first so batches don't end on a long tail
+    scheduling_config = config.get('scheduling', {})
+    estimator = LengthEstimator() if scheduling_config.get('length_aware', False) else None
+    window = batch_size * scheduling_config.get('lookahead_batches', 5)
+    items = list(zip(rows if rows is not None else range(total_questions), questions))
+    if estimator is not None:
+        print(f"Length-aware scheduling over windows of {window} questions")
+    
+    # Hedging state is kept across batches so latency percentiles reflect the whole run
+    hedge_policy = HedgePolicy.from_config(config)
+    if hedge_policy is not None:
+        print(f"Hedging requests slower than p{hedge_policy.percentile} (max {hedge_policy.max_hedge_rate:.0%} of requests)")
+    
+    try:
+        # Process questions in batches
+        for i in range(0, total_questions, batch_size):
+            if stop.is_set():
+                print(f"Stopped before batch {i // batch_size + 1}; run the same command again to resume")
+                break
+            batch_start = time.time()
+            batch_start_trace = tracer.now()
+            if estimator is not None and i % window == 0:
+                with tracer.span("schedule", size=len(items[i:i + window])):
+                    items[i:i + window] = estimator.order(items[i:i + window], key=lambda item: item[1])
+            batch_rows = [row for row, _ in items[i:i + batch_size]]
+            batch_questions = [question for _, question in items[i:i + batch_size]]
+            batch_num = i // batch_size + 1
+            total_batches = (total_questions + batch_size - 1) // batch_size
+            
+            print(f"Processing batch {batch_num}/{total_batches} ({len(batch_questions)} questions)")
+            
+            # Prepare prompts for this batch
+            with tracer.span("prompt_assembly", batch=batch_num, rows=batch_rows):
+                prompts = [f"{question}\n\n{config['prompt']}" for question in batch_questions]
+            
+            # Log dispatch and each completion as it arrives, so a crash mid-batch
+            # doesn't lose responses that were already paid for
+            if wal is not None:
+                for row, question in zip(batch_rows, batch_questions):
+                    wal.dispatched(row, question)
+            
+            def on_complete(index, response, error=None):
+                if wal is None:
+                    return
+                if response is None:
+                    wal.failed(batch_rows[index], batch_questions[index], error)
+                else:
+                    wal.completed(batch_rows[index], batch_questions[index], response)
+            
+            # Get batch responses
+            dispatch_start = tracer.now()
+            if 'azure_deployments' in config:
+                # Use Azure batch API
+                batch_config = config.get('batch_processing', {})
+                max_workers = batch_config.get('max_workers', 5)
+                responses = get_azure_responses_batch(prompts, config['deployment'], config, 
+                                                   batch_size=len(batch_questions), 
+                                                   max_workers=max_workers,
+                                                   hedge_policy=hedge_policy,
+                                                   samples=samples,
+                                                   on_complete=on_complete,
+                                                   rows=batch_rows)
+            elif 'bedrock_models' in config:
+                # Use parallel processing for Bedrock
+                batch_config = config.get('batch_processing', {})
+                max_workers = batch_config.get('max_workers', 3)
+                responses = get_bedrock_responses_parallel(prompts, config_file, max_workers, hedge_policy=hedge_policy,
+                                                           samples=samples, on_complete=on_complete, rows=batch_rows)
+            elif 'ollama_models' in config:
+                # Use parallel processing for Ollama
+                batch_config = config.get('batch_processing', {})
+                max_workers = batch_config.get('max_workers', 3)
+                responses = get_ollama_responses_parallel(prompts, config_file, max_workers, hedge_policy=hedge_policy,
+                                                          samples=samples, on_complete=on_complete, rows=batch_rows)
             else:
-                return f"{seconds/3600:.1f}h"
-        
-        print(f"Batch {batch_num} completed in {format_time(batch_time)} | Avg: {format_time(avg_time)} | ETA: {format_time(estimated_remaining)}\n")
+                # Fallback to sequential for other APIs
+                responses = []
+                for index, prompt in enumerate(prompts):
+                    with tracer.span("request", row=batch_rows[index]):
+                        response = get_solution(prompt, config, config_file, samples, batch_rows[index])
+                    on_complete(index, response)
+                    responses.append(response)
+            tracer.record("dispatch", dispatch_start, batch=batch_num, rows=batch_rows)
+            
+            # Save each solution in the batch
+            for j, (question, solution) in enumerate(zip(batch_questions, responses)):
+                if solution is not None:
+                    current_total = processed_count + i + j + 1
+                    solution, extra = prepare_entry(solution, config, batch_rows[j])
+                    if estimator is not None:
+                        estimator.observe(question, estimate_tokens(solution))
+                    with stop.persisting(), tracer.span("persist", row=batch_rows[j]):
+                        count = append_to_dataset(question, solution, output_path, extra)
+                        if wal is not None:
+                            wal.persisted(batch_rows[j])
+                    print(f"  Saved entry {count} ({j+1}/{len(batch_questions)} in batch)")
+                else:
+                    print(f"  Failed to process question at row {batch_rows[j]}")
+            
+            tracer.record("batch", batch_start_trace, batch=batch_num, rows=batch_rows)
+            batch_time = time.time() - batch_start
+            times.append(batch_time)
+            
+            # Calculate time estimates
+            avg_time = sum(times) / len(times)
+            remaining_batches = total_batches - batch_num
+            estimated_remaining = avg_time * remaining_batches
+            
+            # Format time display
+            def format_time(seconds):
+                if seconds < 60:
+                    return f"{seconds:.1f}s"
+                elif seconds < 3600:
+                    return f"{seconds/60:.1f}m"
+                else:
+                    return f"{seconds/3600:.1f}h"
+            
+            print(f"Batch {batch_num} completed in {format_time(batch_time)} | Avg: {format_time(avg_time)} | ETA: {format_time(estimated_remaining)}\n")
+    finally:
+        if hedge_policy is not None:
+            print(hedge_policy.summary())
+            hedge_policy.close()
     
     return get_processed_count(output_path)
 
-def generate_solutions_sequential(questions, config, output_path, processed_count, config_file=None):
+def generate_solutions_sequential(questions, config, output_path, processed_count, config_file=None, samples=1, rows=None, wal=None, stop=None):
     """Generate solutions using sequential processing (original method)."""
     total_questions = len(questions)
     times = []
+    count = processed_count
+    if stop is None:
+        stop = StopRequest()
     
     for i, question in enumerate(questions):
+        if stop.is_set():
+            print("Stopped; run the same command again to resume")
+            break
+        row = rows[i] if rows is not None else i
         iteration_start = time.time()
         current_total = processed_count + i + 1
         print(f"Processing {current_total}/{len(questions)}: {question[:50]}...")
         
-        prompt = f"{question}\n\n{config['prompt']}"
+        with tracer.span("prompt_assembly", row=row):
+            prompt = f"{question}\n\n{config['prompt']}"
         
-        # Determine which API to use based on config
-        if 'bedrock_models' in config:
-            solution = get_bedrock_response(prompt, config_file)
-        elif 'ollama_models' in config:
-            solution = get_ollama_response(prompt, config_file)
-        else:
-            solution = get_azure_response(prompt, config['deployment'], config)
+        if wal is not None:
+            wal.dispatched(row, question)
+        
+        try:
+            with tracer.span("request", row=row):
+                solution = get_solution(prompt, config, config_file, samples, row)
+        except Exception as e:
+            if wal is not None:
+                wal.failed(row, question, str(e))
+            raise
+        
+        if wal is not None:
+            wal.completed(row, question, solution)
+        solution, extra = prepare_entry(solution, config, row)
         
         iteration_time = time.time() - iteration_start
         times.append(iteration_time)
@@ -155,7 +411,10 @@ def generate_solutions_sequential(questions, config, output_path, processed_coun
         estimated_remaining = avg_time * remaining_questions_count
         
         # Save each solution as it's generated
-        count = append_to_dataset(question, solution, output_path)
+        with stop.persisting(), tracer.span("persist", row=row):
+            count = append_to_dataset(question, solution, output_path, extra)
+            if wal is not None:
+                wal.persisted(row)
         
         # Format time display
         def format_time(seconds):
@@ -179,12 +438,41 @@ def main():
     parser.add_argument('--no-batch', action='store_true', help='Disable batch processing and use sequential processing')
     parser.add_argument('--max-workers', type=int, help='Maximum number of concurrent workers (overrides config)')
     parser.add_argument('--limit', type=int, help='Limit the number of questions to process (for testing)')
+    parser.add_argument('--samples', type=int, help='Number of candidate solutions per question (overrides config)')
+    parser.add_argument('--trace', nargs='?', const='', metavar='FILE',
+                        help='Record per-stage spans to a Chrome trace file (default: output/<output_file>.trace.json)')
+    parser.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                        help='Sample the CPU stacks of all threads to a collapsed-stack file (default: output/<output_file>.profile.folded)')
+    parser.add_argument('--profile-interval', type=float, default=10,
+                        help='Sampling interval in milliseconds for --profile (default: 10)')
     
     args = parser.parse_args()
     
     with open(args.config_file, 'r') as f:
         config = json.load(f)
     
+    output_file = config.get('output_file', 'synthetic_dataset.json')
+    output_path = os.path.join('output', output_file)
+    output_stem = os.path.splitext(output_path)[0]
+    
+    # Tracing and profiling are opt-in; nothing is recorded unless requested
+    if args.trace is not None:
+        tracer.enable(args.trace or f"{output_stem}.trace.json")
+    profiler = None
+    if args.profile is not None:
+        profiler = SamplingProfiler(args.profile or f"{output_stem}.profile.folded",
+                                    interval=args.profile_interval / 1000)
+        profiler.start()
+    
+    try:
+        run(args, config, output_path)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        tracer.save()
+
+def run(args, config, output_path):
+    """Load questions and generate solutions for the parsed command line."""
     # Get batch settings from config with defaults
     batch_config = config.get('batch_processing', {})
     default_batch_size = batch_config.get('batch_size', 10)
@@ -195,30 +483,33 @@ def main():
     # Use config limit as default, command line can override
     limit = args.limit if args.limit is not None else config.get('limit')
     start_row = config.get('start_row', 0)
-    questions = load_tinygsm_questions(limit=limit, start_row=start_row)
+    with tracer.span("load_dataset"):
+        questions = load_tinygsm_questions(limit=limit, start_row=start_row)
     print(f"Loaded {len(questions)} questions starting from row {start_row}")
     
     # Create output directory if it doesn't exist
     os.makedirs('output', exist_ok=True)
     
-    output_file = config.get('output_file', 'synthetic_dataset.json')
-    output_path = os.path.join('output', output_file)
-    
     # Determine final batch settings (command line overrides config)
     batch_size = args.batch_size if args.batch_size is not None else default_batch_size
     max_workers = args.max_workers if args.max_workers is not None else default_max_workers
     use_batch = not args.no_batch and default_batch_enabled
+    samples = args.samples if args.samples is not None else config.get('samples_per_question', 1)
     
     # Print processing configuration
     if not use_batch:
         print("Using sequential processing")
     else:
         print(f"Using batch processing with batch size {batch_size} and max workers {max_workers}")
+    if samples > 1:
+        print(f"Generating {samples} candidate solutions per question")
     
     total_count = generate_solutions(questions, config, output_path, 
                                    batch_size=batch_size, 
                                    use_batch=use_batch,
-                                   config_file=args.config_file)
+                                   config_file=args.config_file,
+                                   samples=samples,
+                                   start_row=start_row)
     print(f"Completed! Saved {total_count} examples to {output_path}")
     
     if config.get('upload_to_hf', False):
@@ -5,20 +5,31 @@ import os
 import time
 import asyncio
 import aiohttp
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.tracing import tracer
+from utils.hedging import call_with_hedging, request_timeout
+from utils.sampling import fan_out_samples, collect_as_completed
 
 def _is_rift_endpoint(endpoint):
     """Check if the endpoint is a Rift API endpoint"""
     return "cloudrift.ai" in endpoint or "rift" in endpoint.lower()
 
-def _create_client(deployment):
+def _create_client(deployment, timeout=None):
     """Create appropriate OpenAI client based on endpoint type"""
+    # Optional client-side timeout in seconds. The client's own retries are
+    # turned off so a stuck request is bounded by a single timeout
+    client_options = {}
+    if timeout is not None:
+        client_options["timeout"] = timeout
+        client_options["max_retries"] = 0
+    
     if _is_rift_endpoint(deployment["endpoint"]):
         # Use standard OpenAI client for Rift
         return openai.OpenAI(
             api_key=deployment["api_key"],
-            base_url=deployment["endpoint"]
+            base_url=deployment["endpoint"],
+            **client_options
         )
     else:
         # Use Azure OpenAI client for Azure endpoints
@@ -32,13 +43,15 @@ def _create_client(deployment):
         return openai.AzureOpenAI(
             api_key=deployment["api_key"],
             api_version=api_version,
-            azure_endpoint=deployment["endpoint"]
+            azure_endpoint=deployment["endpoint"],
+            **client_options
         )
 
-def get_azure_response(prompt, deployment_name, config):
+def get_azure_response(prompt, deployment_name, config, n=1):
+    """Get a completion for one prompt; with n > 1, returns a list of n completions."""
     deployment = config['azure_deployments'][deployment_name]
     
-    client = _create_client(deployment)
+    client = _create_client(deployment, request_timeout(config, deployment))
     
     max_retries = 5
     base_delay = 1
@@ -49,6 +62,10 @@ def get_azure_response(prompt, deployment_name, config):
         "messages": [{"role": "user", "content": prompt}]
     }
     
+    # Several samples share one prompt charge when requested via n
+    if n > 1:
+        request_params["n"] = n
+    
     # Add reasoning parameters for o4-mini model
     if "o4-mini" in deployment["model"] and "2025-04-01-preview" in api_version:
         request_params["reasoning_effort"] = "high"
@@ -56,12 +73,18 @@ def get_azure_response(prompt, deployment_name, config):
     for attempt in range(max_retries):
         try:
             response = client.chat.completions.create(**request_params)
+            if n > 1:
+                return [choice.message.content for choice in response.choices]
             return response.choices[0].message.content
             
         except openai.RateLimitError as e:
             print(f"Rate limit hit: {e}")
             raise Exception("RATE_LIMIT_EXCEEDED")
             
+        except openai.APITimeoutError:
+            # Timeouts are final; retrying would multiply request_timeout
+            raise
+            
         except openai.APIError as e:
             if attempt == max_retries - 1:
                 raise e
@@ -72,7 +95,7 @@ def get_azure_response(prompt, deployment_name, config):
     
     raise Exception(f"Failed after {max_retries} attempts")
 
-def get_azure_responses_batch(prompts, deployment_name, config, batch_size=10, max_workers=5):
+def get_azure_responses_batch(prompts, deployment_name, config, batch_size=10, max_workers=5, hedge_policy=None, samples=1, on_complete=None, rows=None):
     """
     Process multiple prompts in parallel batches for faster inference.
     
@@ -82,19 +105,41 @@ def get_azure_responses_batch(prompts, deployment_name, config, batch_size=10, m
         config: Configuration dictionary
         batch_size: Number of prompts to process in each batch
         max_workers: Maximum number of concurrent workers
+        hedge_policy: Optional HedgePolicy that duplicates slow requests
+        samples: Number of completions per prompt
+        on_complete: Optional callback(index, response, error) called as each
+            prompt finishes; response is None and error is the message if it failed
+        rows: Optional source row ids of the prompts, used to tag trace spans
     
     Returns:
-        List of responses in the same order as input prompts
+        List of responses in the same order as input prompts; with samples > 1,
+        each entry is a list of completions (or None if all of them failed)
     """
     deployment = config['azure_deployments'][deployment_name]
     
-    def process_single_prompt(prompt_data):
+    if samples > 1 and not deployment.get("supports_n", True):
+        # Endpoint ignores n: send one request per sample and regroup them
+        return fan_out_samples(
+            lambda expanded, collect, expanded_rows: get_azure_responses_batch(
+                expanded, deployment_name, config, batch_size * samples, max_workers, hedge_policy,
+                on_complete=collect, rows=expanded_rows),
+            prompts, samples, on_complete, rows)
+    
+    def request(prompt, name, row):
+        return call_with_hedging(hedge_policy, lambda target: get_azure_response(prompt, target, config, n=samples),
+                                 name, row)
+    
+    def process_single_prompt(prompt_data, submitted):
         prompt, index = prompt_data
+        row = rows[index] if rows is not None else index
+        tracer.record("queue_wait", submitted, row=row)
         try:
-            return get_azure_response(prompt, deployment_name, config), index
+            with tracer.span("request", row=row, deployment=deployment_name):
+                return request(prompt, deployment_name, row), index, None
         except Exception as e:
             print(f"Error processing prompt {index}: {e}")
-            return None, index
+            tracer.mark("request_failed", row=row, error=str(e))
+            return None, index, str(e)
     
     results = [None] * len(prompts)
     prompt_data = [(prompt, i) for i, prompt in enumerate(prompts)]
@@ -105,16 +150,20 @@ def get_azure_responses_batch(prompts, deployment_name, config, batch_size=10, m
         print(f"Processing batch {i//batch_size + 1}/{(len(prompt_data) + batch_size - 1)//batch_size} ({len(batch)} prompts)")
         
         with ThreadPoolExecutor(max_workers=min(max_workers, len(batch))) as executor:
-            future_to_prompt = {executor.submit(process_single_prompt, prompt_data): prompt_data for prompt_data in batch}
+            future_to_prompt = {executor.submit(process_single_prompt, prompt_data, tracer.now()): prompt_data for prompt_data in batch}
             
-            for future in as_completed(future_to_prompt):
+            def handle(future):
                 try:
-                    response, index = future.result()
+                    response, index, error = future.result()
                     if response is not None:
                         results[index] = response
+                    if on_complete is not None:
+                        on_complete(index, response, error)
                 except Exception as e:
                     prompt_data = future_to_prompt[future]
                     print(f"Error processing prompt {prompt_data[1]}: {e}")
+            
+            collect_as_completed(executor, future_to_prompt, handle)
     
     return results
 
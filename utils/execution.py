@@ -0,0 +1,104 @@
+import re
+import sys
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+FENCED_CODE = re.compile(r"```(?:python|py)?\s*\n(.*?)```", re.DOTALL)
+FUNCTION_DEF = re.compile(r"^def\s+(\w+)\s*\(([^)]*)\)", re.MULTILINE)
+# Unindented lines that still belong to the code rather than to prose after it
+IMPORT = re.compile(r"^(import \w|from [\w.]+ import )", re.MULTILINE)
+TOP_LEVEL_CODE = re.compile(r"^(def |class |import |from |@|#|if __name__|[A-Za-z_][\w.]*\s*(=|\())")
+ENTRY_POINT = "simple_math_problem"
+
+
+def extract_code(solution):
+    """Pull the Python solution function out of a model response."""
+    if not solution:
+        return None
+    blocks = FENCED_CODE.findall(solution)
+    for block in blocks:
+        if FUNCTION_DEF.search(block):
+            return block
+    match = FUNCTION_DEF.search(solution)
+    if not match:
+        return None
+    # No code fence: start at the first import or def and keep lines up to
+    # the first unindented line of prose
+    start = match.start()
+    first_import = IMPORT.search(solution, 0, start)
+    if first_import:
+        start = first_import.start()
+    lines = []
+    for line in solution[start:].splitlines():
+        if line.strip() and not line[0].isspace() and not TOP_LEVEL_CODE.match(line):
+            break
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def entry_point(code):
+    """Name of the function to call: simple_math_problem if defined, else the last zero-argument function."""
+    functions = FUNCTION_DEF.findall(code)
+    if any(name == ENTRY_POINT for name, _ in functions):
+        return ENTRY_POINT
+    zero_arg = [name for name, params in functions if not params.strip()]
+    return zero_arg[-1] if zero_arg else None
+
+
+def execute_solution(solution, timeout=5):
+    """
+    Run the solution function in a separate interpreter and return its result.
+
+    The code runs in a separate Python process with a timeout. This is not a
+    sandbox: the code has the same access to this machine as the generator.
+    Returns the result as a normalized string, or None if the code could not
+    be found, failed, or timed out.
+    """
+    code = extract_code(solution)
+    if code is None:
+        return None
+    function_name = entry_point(code)
+    if function_name is None:
+        return None
+    script = f"{code}\n\nprint(repr({function_name}()))\n"
+    try:
+        # A new session keeps Ctrl-C on the terminal from killing candidates mid-vote
+        result = subprocess.run([sys.executable, "-I", "-c", script],
+                                capture_output=True, text=True, timeout=timeout,
+                                start_new_session=True)
+    except subprocess.TimeoutExpired:
+        return None
+    if result.returncode != 0 or not result.stdout.strip():
+        return None
+    return normalize_answer(result.stdout.strip().splitlines()[-1])
+
+
+def normalize_answer(value):
+    """Normalize printed results so 4, 4.0 and 4.0000001 compare equal."""
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    number = round(number, 6)
+    if number.is_integer():
+        return str(int(number))
+    return str(number)
+
+
+def majority_answer(solutions, timeout=5):
+    """
+    Execute the candidates in parallel and find the most common answer.
+
+    Returns:
+        Tuple of (answer, index of the first candidate giving it, number of
+        candidates that agree, answers per candidate); answer is None if no
+        candidate executed successfully.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(solutions))) as executor:
+        answers = list(executor.map(lambda s: execute_solution(s, timeout), solutions))
+    counts = Counter(a for a in answers if a is not None)
+    if not counts:
+        return None, 0, 0, answers
+    answer, votes = counts.most_common(1)[0]
+    return answer, answers.index(answer), votes, answers
@@ -0,0 +1,195 @@
+import os
+import sys
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.tracing import tracer
+
+# Seconds a request may run when hedging is enabled and the model sets no request_timeout
+DEFAULT_HEDGE_TIMEOUT = 120
+
+
+def call_with_hedging(hedge_policy, call, deployment, row=None):
+    """Run call(deployment), through hedge_policy when one is given."""
+    if hedge_policy is None:
+        return call(deployment)
+    return hedge_policy.call(call, deployment, row=row)
+
+
+def request_timeout(config, model_config):
+    """
+    Client timeout in seconds for one request, or None for the client default.
+
+    A model's own request_timeout wins. With hedging enabled a finite timeout is
+    always used (hedging.request_timeout, default DEFAULT_HEDGE_TIMEOUT): a
+    hedged loser that has already started cannot be cancelled, so without one
+    a stuck request would hold a hedge thread forever.
+    """
+    if model_config.get("request_timeout") is not None:
+        return model_config["request_timeout"]
+    hedge_config = config.get('hedging', {})
+    if hedge_config.get('enabled', False):
+        return hedge_config.get('request_timeout', DEFAULT_HEDGE_TIMEOUT)
+    return None
+
+
+class LatencyTracker:
+    """Sliding window of recent successful request latencies for one deployment."""
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class HedgePolicy:
+    """
+    Issues a duplicate request once the original runs past a latency percentile.
+
+    Latencies are tracked per deployment. When a request is still running after
+    the configured percentile of its deployment's recent latencies, a second copy
+    is sent to the next deployment in `deployments` (or the same one) and the
+    first successful answer is returned. The loser is cancelled if it has not
+    started yet; otherwise its result is discarded when it finishes. Hedges are
+    capped at `max_hedge_rate` of all requests so a slow provider cannot double
+    the bill. Latencies and the hedge delay are measured from when a request
+    actually starts, not from when it was queued.
+    """
+
+    def __init__(self, percentile=95, min_samples=20, max_hedge_rate=0.1,
+                 deployments=None, window=200, max_workers=32):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_hedge_rate = max_hedge_rate
+        self.deployments = deployments or []
+        self.window = window
+        self.trackers = {}
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a policy from the `hedging` config section, or None if disabled."""
+        hedge_config = config.get('hedging', {})
+        if not hedge_config.get('enabled', False):
+            return None
+        # Room for every batch worker's original request plus a hedge
+        batch_workers = config.get('batch_processing', {}).get('max_workers', 5)
+        return cls(
+            percentile=hedge_config.get('percentile', 95),
+            min_samples=hedge_config.get('min_samples', 20),
+            max_hedge_rate=hedge_config.get('max_hedge_rate', 0.1),
+            deployments=hedge_config.get('deployments'),
+            window=hedge_config.get('window', 200),
+            max_workers=hedge_config.get('max_workers', 2 * batch_workers)
+        )
+
+    def _tracker(self, deployment):
+        with self._lock:
+            if deployment not in self.trackers:
+                self.trackers[deployment] = LatencyTracker(self.window)
+            return self.trackers[deployment]
+
+    def threshold(self, deployment):
+        """Seconds to wait before hedging a request, or None if there is not enough history."""
+        tracker = self._tracker(deployment)
+        if len(tracker) < self.min_samples:
+            return None
+        return tracker.percentile(self.percentile)
+
+    def _hedge_target(self, deployment):
+        alternates = [d for d in self.deployments if d != deployment]
+        if not alternates:
+            return deployment
+        with self._lock:
+            return alternates[self.hedges % len(alternates)]
+
+    def _reserve_hedge(self):
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_rate * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def _submit(self, call, deployment):
+        """Submit call(deployment); returns the future and an Event set when it starts running."""
+        tracker = self._tracker(deployment)
+        started = threading.Event()
+
+        def timed():
+            started.set()
+            start = time.time()
+            result = call(deployment)
+            tracker.add(time.time() - start)
+            return result
+
+        return self._executor.submit(timed), started
+
+    def call(self, call, deployment, row=None):
+        """
+        Run call(deployment), hedging it if it becomes slow.
+
+        Args:
+            call: Function taking a deployment name and returning a response
+            deployment: Deployment the original request goes to
+            row: Optional source row id, used to tag trace events
+
+        Returns:
+            The first successful response; raises the original request's error
+            if every attempt fails.
+        """
+        with self._lock:
+            self.requests += 1
+
+        primary, started = self._submit(call, deployment)
+        delay = self.threshold(deployment)
+        if delay is not None:
+            started.wait()
+            done, _ = wait([primary], timeout=delay)
+            if not done and self._reserve_hedge():
+                target = self._hedge_target(deployment)
+                tracer.mark("hedge_issued", row=row, deployment=deployment, target=target, after=delay)
+                hedge, _ = self._submit(call, target)
+                return self._first_success(primary, hedge, row)
+        return primary.result()
+
+    def _first_success(self, primary, hedge, row=None):
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if future is hedge:
+                        with self._lock:
+                            self.hedge_wins += 1
+                        tracer.mark("hedge_won", row=row)
+                    return future.result()
+        return primary.result()
+
+    def close(self):
+        """Stop the hedge threads, dropping queued requests instead of waiting for them."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def summary(self):
+        return f"Hedging: {self.hedges} hedges for {self.requests} requests ({self.hedge_wins} won)"
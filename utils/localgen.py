@@ -1,15 +1,20 @@
 import os
+import sys
 import json
 from litellm import completion
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.tracing import tracer
+from utils.hedging import call_with_hedging, request_timeout
+from utils.sampling import fan_out_samples, collect_as_completed
 
-def get_ollama_response(prompt, config_file="ollama-config.json"):
+def get_ollama_response(prompt, config_file="ollama-config.json", deployment_name=None):
     # Load config file
     with open(config_file, 'r') as f:
         config = json.load(f)
     
     # Get model config
-    model_config = config['ollama_models'][config['deployment']]
+    model_config = config['ollama_models'][deployment_name or config['deployment']]
     
     # Set Ollama base URL if specified
     if 'base_url' in model_config:
@@ -22,33 +27,70 @@ def get_ollama_response(prompt, config_file="ollama-config.json"):
         model=model_name,
         messages=[{ "content": prompt, "role": "user"}],
         temperature=model_config.get("temperature", 0.7),
-        max_tokens=model_config.get("max_tokens", 2000)
+        max_tokens=model_config.get("max_tokens", 2000),
+        api_base=model_config.get("base_url"),
+        timeout=request_timeout(config, model_config)
     )
     return response.choices[0].message.content
 
-def get_ollama_responses_parallel(prompts, config_file="ollama-config.json", max_workers=3):
-    """Process multiple prompts in parallel for faster batch processing."""
+def get_ollama_responses_parallel(prompts, config_file="ollama-config.json", max_workers=3, hedge_policy=None, samples=1, on_complete=None, rows=None):
+    """
+    Process multiple prompts in parallel for faster batch processing.
+    
+    Args:
+        prompts: List of prompts to process
+        config_file: Path to the configuration file
+        max_workers: Maximum number of concurrent workers
+        hedge_policy: Optional HedgePolicy that duplicates slow requests
+        samples: Number of completions per prompt; the provider has no n
+            parameter, so each prompt is sent samples times concurrently
+        on_complete: Optional callback(index, response, error) called as each
+            prompt finishes; response is None and error is the message if it failed
+        rows: Optional source row ids of the prompts, used to tag trace spans
+    
+    Returns:
+        List of responses in the same order as input prompts; with samples > 1,
+        each entry is a list of completions (or None if all of them failed)
+    """
+    if samples > 1:
+        return fan_out_samples(
+            lambda expanded, collect, expanded_rows: get_ollama_responses_parallel(
+                expanded, config_file, max_workers, hedge_policy, on_complete=collect, rows=expanded_rows),
+            prompts, samples, on_complete, rows)
+    
     responses = [None] * len(prompts)
     
-    def process_single_prompt(index, prompt):
+    with open(config_file, 'r') as f:
+        deployment = json.load(f)['deployment']
+    
+    def process_single_prompt(index, prompt, submitted):
+        row = rows[index] if rows is not None else index
+        tracer.record("queue_wait", submitted, row=row)
         try:
-            response = get_ollama_response(prompt, config_file)
-            return index, response
+            with tracer.span("request", row=row):
+                response = call_with_hedging(hedge_policy, lambda target: get_ollama_response(prompt, config_file, target),
+                                             deployment, row)
+            return index, response, None
         except Exception as e:
             print(f"Error processing prompt {index}: {e}")
-            return index, None
+            tracer.mark("request_failed", row=row, error=str(e))
+            return index, None, str(e)
     
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         # Submit all tasks
         future_to_index = {
-            executor.submit(process_single_prompt, i, prompt): i 
+            executor.submit(process_single_prompt, i, prompt, tracer.now()): i 
             for i, prompt in enumerate(prompts)
         }
         
         # Collect results as they complete
-        for future in as_completed(future_to_index):
-            index, response = future.result()
+        def handle(future):
+            index, response, error = future.result()
             responses[index] = response
+            if on_complete is not None:
+                on_complete(index, response, error)
+        
+        collect_as_completed(executor, future_to_index, handle)
     
     return responses
 
@@ -0,0 +1,61 @@
+from concurrent.futures import as_completed
+
+
+def collect_as_completed(executor, futures, handle):
+    """
+    Call handle(future) for each future as it finishes.
+
+    A KeyboardInterrupt (a second Ctrl-C) cancels the requests that have not
+    started yet, but the ones already running are still waited for and handled,
+    so their responses reach the write-ahead log before the interrupt is re-raised.
+    """
+    pending = set(futures)
+    try:
+        for future in as_completed(futures):
+            handle(future)
+            pending.discard(future)
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future in as_completed([f for f in pending if not f.cancelled()]):
+            handle(future)
+        raise
+
+
+def fan_out_samples(fn, prompts, samples, on_complete=None, rows=None):
+    """
+    Send every prompt `samples` times and regroup the completions per prompt.
+
+    Used for providers (or endpoints) without an n parameter.
+
+    Args:
+        fn: Batch helper called as fn(expanded_prompts, on_complete, rows); it must
+            return one response per prompt (None on failure) and call
+            on_complete(index, response, error) as each one finishes
+        prompts: List of prompts
+        samples: Number of completions per prompt
+        on_complete: Optional callback(index, completions, error) called once all
+            samples of a prompt are in; completions is None if every sample failed,
+            and error is then the last sample's error
+        rows: Optional source row ids of the prompts, used to tag trace spans
+
+    Returns:
+        List with one list of completions (or None) per prompt
+    """
+    expanded = [prompt for prompt in prompts for _ in range(samples)]
+    expanded_rows = [row for row in rows for _ in range(samples)] if rows is not None else None
+    groups = [[] for _ in prompts]
+
+    errors = [None] * len(prompts)
+
+    def collect(index, response, error=None):
+        group = groups[index // samples]
+        group.append(response)
+        if error is not None:
+            errors[index // samples] = error
+        if on_complete is not None and len(group) == samples:
+            completions = [r for r in group if r is not None] or None
+            on_complete(index // samples, completions, errors[index // samples] if completions is None else None)
+
+    flat = fn(expanded, collect, expanded_rows)
+    return [[r for r in flat[i * samples:(i + 1) * samples] if r is not None] or None
+            for i in range(len(prompts))]
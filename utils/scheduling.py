@@ -0,0 +1,76 @@
+import re
+import threading
+
+NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def question_features(question):
+    """Cheap features that correlate with solution length: words, numbers, sentences."""
+    words = len(question.split())
+    numbers = len(NUMBER.findall(question))
+    sentences = max(1, question.count('.') + question.count('?') + question.count('!'))
+    return [1.0, float(words), float(numbers), float(sentences)]
+
+
+def estimate_tokens(text):
+    """Rough token count of a completion (about 4 characters per token)."""
+    return len(text) / 4 if text else 0
+
+
+class LengthEstimator:
+    """
+    Predicts completion length from question features.
+
+    Starts from a fixed prior and is refined online by least squares on the
+    observed completion lengths, so the ordering adapts to the model and prompt
+    in use. A ridge term keeps the fit close to the prior until enough
+    completions have been observed.
+    """
+
+    PRIOR = [60.0, 1.5, 8.0, 10.0]
+
+    def __init__(self, ridge=10.0):
+        size = len(self.PRIOR)
+        # Normal equations for ridge regression towards PRIOR
+        self.xtx = [[ridge if r == c else 0.0 for c in range(size)] for r in range(size)]
+        self.xty = [ridge * w for w in self.PRIOR]
+        self.weights = list(self.PRIOR)
+        self.observed = 0
+        self._lock = threading.Lock()
+
+    def predict(self, question):
+        features = question_features(question)
+        return sum(w * x for w, x in zip(self.weights, features))
+
+    def observe(self, question, tokens):
+        features = question_features(question)
+        with self._lock:
+            for r, xr in enumerate(features):
+                self.xty[r] += xr * tokens
+                for c, xc in enumerate(features):
+                    self.xtx[r][c] += xr * xc
+            self.observed += 1
+            self.weights = _solve(self.xtx, self.xty) or self.weights
+
+    def order(self, items, key=lambda item: item):
+        """Sort items longest-predicted first (LPT), so the pools finish together."""
+        return sorted(items, key=lambda item: self.predict(key(item)), reverse=True)
+
+
+def _solve(a, b):
+    """Solve a small linear system by Gaussian elimination; None if singular."""
+    size = len(b)
+    m = [list(row) + [b[i]] for i, row in enumerate(a)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(col + 1, size):
+            factor = m[r][col] / m[col][col]
+            for c in range(col, size + 1):
+                m[r][c] -= factor * m[col][c]
+    x = [0.0] * size
+    for r in range(size - 1, -1, -1):
+        x[r] = (m[r][size] - sum(m[r][c] * x[c] for c in range(r + 1, size))) / m[r][r]
+    return x
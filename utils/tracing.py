@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    Collects per-stage spans and writes them as a Chrome trace file.
+
+    The output can be opened in chrome://tracing or https://ui.perfetto.dev.
+    While disabled, now(), span() and record() return immediately without
+    touching the clock or the event list.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.events = []
+        self._thread_names = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+
+    def enable(self, path):
+        self.enabled = True
+        self.path = path
+        self.events = []
+        self._thread_names = {}
+        self._origin = time.perf_counter()
+
+    def now(self):
+        """Timestamp on the tracer's clock, usable as a span start (0 while disabled)."""
+        if not self.enabled:
+            return 0.0
+        return time.perf_counter()
+
+    def record(self, name, start, end=None, **args):
+        """Record a finished span that began at `start` (from now())."""
+        if not self.enabled:
+            return
+        if end is None:
+            end = time.perf_counter()
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self._origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self._pid,
+            "tid": threading.get_ident(),
+            "args": args
+        }
+        self._append(event)
+
+    def mark(self, name, **args):
+        """Record an instant event, e.g. a failure or a retry."""
+        if not self.enabled:
+            return
+        event = {
+            "name": name,
+            "ph": "i",
+            "s": "t",
+            "ts": (time.perf_counter() - self._origin) * 1e6,
+            "pid": self._pid,
+            "tid": threading.get_ident(),
+            "args": args
+        }
+        self._append(event)
+
+    def _append(self, event):
+        with self._lock:
+            self.events.append(event)
+            if event["tid"] not in self._thread_names:
+                self._thread_names[event["tid"]] = threading.current_thread().name
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, **args)
+
+    def save(self):
+        """Write collected events to the trace file."""
+        if not self.enabled or not self.path:
+            return
+        with self._lock:
+            events = list(self.events)
+            thread_names = dict(self._thread_names)
+        for tid, thread_name in thread_names.items():
+            events.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self._pid,
+                "tid": tid,
+                "args": {"name": thread_name}
+            })
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print(f"Trace written to {self.path} ({len(events)} events)")
+
+
+# Modules whose frames, when on top of the stack, mean the thread is blocked
+# waiting (on a worker, a lock or a socket) rather than using CPU
+IDLE_MODULES = {"threading.py", "selectors.py", "socket.py", "ssl.py", "queue.py", "subprocess.py"}
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the Python stack of every thread as a CPU profile.
+
+    Samples from threads blocked waiting on a worker, a lock or a socket are
+    counted as idle and left out, so the profile shows where CPU time goes:
+    prompt assembly and JSON writes on the main thread, response decoding and
+    client overhead in the pool and hedge threads. Each stack is prefixed with
+    its thread name and written in collapsed-stack format
+    ("thread;frame;frame count"), which flamegraph.pl and speedscope read
+    directly. Nothing runs until start() is called.
+    """
+
+    def __init__(self, path, interval=0.01):
+        self.path = path
+        self.interval = interval
+        self.samples = Counter()
+        self.idle = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if os.path.basename(frame.f_code.co_filename) in IDLE_MODULES:
+                    self.idle += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"CPU profile written to {self.path} ({sum(self.samples.values())} busy samples, {self.idle} idle)")
+
+
+# Shared tracer used by generate.py and the provider modules; disabled by default
+tracer = Tracer()